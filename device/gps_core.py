@@ -0,0 +1,162 @@
+'''
+Shared code used by the device apps to read and decode GPS coordinates from a GPS sensor.
+
+You can learn more about tracking with GPS and managing GPS data in the third project of
+the IoT for Beginners curriculum:
+
+https://github.com/microsoft/IoT-For-Beginners/tree/main/3-transport
+'''
+import functools
+import re
+from typing import Awaitable, Callable, NamedTuple, Optional
+
+# The numba library can compile the maths used to convert GPS positions to machine code.
+# This is optional - if numba isn't installed, the maths is run as normal Python code
+try:
+    from numba import njit
+except ImportError:
+    def njit(*_args, **_kwargs):
+        '''
+        A stand-in for the numba njit decorator that leaves the decorated function unchanged
+        '''
+        def decorator(func):
+            return func
+        return decorator
+
+# The pyserial library is used to read serial data over a UART connection to
+# the GPS sensor
+import serial
+
+class LatLon(NamedTuple):
+    '''
+    A named tuple type to define a GPS coordinate as a latitude and longitude,
+    along with the number of satellites use to get the fix
+    '''
+    lat: float
+    lon: float
+    num_satellites: int
+
+def flush_serial(serial_conn: serial.Serial) -> None:
+    '''
+    Drains the serial data from the UART connection.
+    This is done so we can read data every few seconds, and ignore the data in-between
+    '''
+    # Clear the input buffer to remove all data
+    serial_conn.reset_input_buffer()
+
+    # The data is NMEA sentences, which are plain ASCII, so there's no need to decode anything here.
+    # Read and discard the data up to the end of the current line so the next read starts on a full line
+    serial_conn.read_until(b'\n')
+
+# A regular expression that matches a full GGA sentence, as these are the ones with the GPS position.
+# Sentences start with a $, then a 2 character talker ID, such as GP for GPS or GN for multiple
+# satellite systems, then the sentence type. The groups captured are:
+#
+# 1 - the sentence data between the $ and *, used to check the checksum
+# 2, 3 - the lat and N/S
+# 4, 5 - the lon and E/W
+# 6 - the number of satellites
+# 7 - the checksum
+#
+# If the GPS sensor doesn't have a fix yet, the lat and lon are empty so the sentence won't match.
+# None of the fields can contain a line ending or a $, so a match never runs on from a truncated
+# sentence into the next one
+GGA_RE = re.compile(rb'\$(G[PNLA]GGA,[^,\r\n$]*,(\d+\.\d+),([NS]),(\d+\.\d+),([EW]),[^,\r\n$]*,(\d+)[^*\r\n$]*)'
+                    rb'\*([0-9A-Fa-f]{2})')
+
+# Compile this to machine code with numba if it is installed. The compiled code is cached on disk
+# next to this module, so it only needs to be compiled once and is shared by all the device apps
+@njit(cache=True)
+def dm_value_to_sd(value: float) -> float:
+    '''
+    Converts a position in degrees and minutes, such as 4807.038, to decimal degrees.
+    '''
+    degrees = int(value // 100)
+    return degrees + (value - degrees * 100) / 60.0
+
+# The GPS sensor sends the same position over and over when the animal isn't moving much,
+# so cache the most recent conversions rather than calculating them again each time
+@functools.lru_cache(maxsize=256)
+def dm_to_sd(dm: bytes) -> float:
+    '''
+    Converts a position in degrees and minutes from an NMEA sentence to decimal degrees.
+
+    The position is in the format dddmm.mmmm, so 4807.038 is 48 degrees and 7.038 minutes.
+    '''
+    return dm_value_to_sd(float(dm))
+
+def has_valid_checksum(data: bytes, checksum: bytes) -> bool:
+    '''
+    Checks the checksum at the end of an NMEA sentence.
+
+    Each sentence ends with *XX, where XX is the hex value of all the characters
+    between the $ and the * XORed together. If this doesn't match, the sentence was corrupted.
+    '''
+    calculated = 0
+    for byte in data:
+        calculated ^= byte
+
+    return int(checksum, 16) == calculated
+
+def decode_location(match: re.Match) -> Optional[LatLon]:
+    '''
+    Decodes the lat, lon and number of satellites from a GGA sentence matched by GGA_RE.
+
+    If the sentence is corrupted, None is returned.
+    '''
+    # Get all the fields captured by GGA_RE in one go, in the order they appear in the sentence
+    data, lat_dm, lat_dir, lon_dm, lon_dir, num_satellites, checksum = match.groups()
+
+    # If the sentence read is corrupted, the checksum won't match
+    if not has_valid_checksum(data, checksum):
+        return None
+
+    # The values are in degrees and minutes, so convert to decimal degrees.
+    # The positions are given as N/S or E/W. For decimal degrees, these should be converted
+    # to positive or negative values. S of the equator is negative, so is west of the
+    # prime meridian
+    lat = dm_to_sd(lat_dm)
+    lat = -lat if lat_dir == b'S' else lat
+
+    lon = dm_to_sd(lon_dm)
+    lon = -lon if lon_dir == b'W' else lon
+
+    # Return the lat, lon, and number of satellites as a tuple
+    return LatLon(lat, lon, int(num_satellites))
+
+async def get_next_location(read: Callable[[int], Awaitable[bytes]]) -> LatLon:
+    '''
+    Gets the next lat and lon pair from the GPS sensor.
+
+    This reads blocks of data from the serial port until a GGA sentence is read - this is the sentence
+    with the GPS coordinates read from satelites. Once this sentence is read, the lat and lon
+    are returned as a tuple.
+
+    The data is read using the read function passed in. This is called with the number of bytes to read,
+    and is awaited to get the data. This allows the same code to be used with different serial libraries.
+
+    If no GPS coordinates are found, -999, -999 is returned.
+    '''
+    # The GPS sensor sends a GGA sentence every second. At 9,600 baud, 1KB of data is about a second
+    # of sentences, so read the data in blocks of 1KB and search each one for a GGA sentence.
+    # This code will try 4 blocks to get a valid GGA sentence, that is a sentence that has GPS
+    # coordinates from multiple satellites
+    buffer = bytearray()
+
+    # Start looping looking for a GGA sentence
+    for _ in range(4):
+        # Read the next block of data
+        buffer += await read(1024)
+
+        # Search the data read for full GGA sentences, and return the first one that decodes correctly
+        for match in GGA_RE.finditer(buffer):
+            lat_lon = decode_location(match)
+            if lat_lon is not None:
+                return lat_lon
+
+        # None of the full lines read so far have a GPS position, so discard them.
+        # Any partial line at the end is kept in the buffer until the rest of it is read
+        del buffer[:buffer.rfind(b'\n') + 1]
+
+    # If we don't successfully get a lat and lon, return -999,-999 with no satellites
+    return LatLon(-999, -999, 0)
@@ -6,32 +6,17 @@ the IoT for Beginners curriculum:
 
 https://github.com/microsoft/IoT-For-Beginners/tree/main/3-transport
 '''
+import sys
+from pathlib import Path
 
 # The pyserial library is used to read serial data over a UART connection to
 # the GPS sensor
 import serial
 
-def flush_serial(serial_conn: serial.Serial) -> None:
-    '''
-    Drains the serial data from the UART connection.
-    This is done so we can read data every 10 seconds, and ignore the data in-between
-    '''
-    # Clear and flush the input buffer to remove all data
-    serial_conn.reset_input_buffer()
-    serial_conn.flush()
-
-    # Try to read and decode a line. This is needed as the data is utf-8, so can be variable width
-    # and we don't want to read a partial line that starts part-way through a variable width character.
-    # The code here will read until is gets a full line that can be decoded successfully
-    read_line = None
-    while read_line is None:
-        try:
-            # Decode the line as utf-8
-            read_line = serial_conn.readline().decode('utf-8')
-        except UnicodeDecodeError:
-            # If we are reading part way through a character, this exception will be thrown.
-            # Reset the line and read again
-            read_line = None
+# The gps_core module contains the code shared by all the device apps to read and decode
+# GPS coordinates. This lives in the parent folder, so add that to the module search path
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+from gps_core import flush_serial  # pylint: disable=wrong-import-position
 
 # Connect to the GPS sensor. This is always a serial connection at 9,600 baud
 # on the /dev/ttyAMA0 port
@@ -43,7 +28,8 @@ flush_serial(serial_connection)
 # The main loop of the application. Loop forever
 # There is no pause here - the application will block whilst waiting for a new line from the serial port
 while True:
-    # Read the line of data from the serial connection
-    line = serial_connection.readline().decode('utf-8').strip()
+    # Read the line of data from the serial connection. NMEA sentences are plain ASCII, so the line
+    # is only decoded when it is printed. Any invalid bytes from a corrupted line are dropped
+    line = serial_connection.readline().strip()
     if line:
-        print(line)
+        print(line.decode('ascii', 'ignore'))
@@ -7,19 +7,25 @@ the IoT for Beginners curriculum:
 https://github.com/microsoft/IoT-For-Beginners/tree/main/3-transport
 '''
 import asyncio
-import json
 import os
+import sys
+from collections import deque
+from datetime import datetime, timezone
+from pathlib import Path
 from typing import NamedTuple
 
-# The pynmea2 library is used to decode NMEA sentences
-# These are the messages that are sent by GPS devices
-# You can read more about NMEA sentences at
-# https://github.com/microsoft/IoT-For-Beginners/tree/main/3-transport/lessons/1-location-tracking#nmea-gps-data
-import pynmea2
+# The uvloop library is a faster replacement for the asyncio event loop, built on libuv. On Linux this
+# waits for both the serial data and the IoT Hub connection using epoll. This is optional - if uvloop
+# isn't installed, the standard asyncio event loop is used
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
 
-# The pyserial library is used to read serial data over a UART connection to
-# the GPS sensor
-import serial
+# The pyserial-asyncio library is used to read serial data over a UART connection to
+# the GPS sensor. Unlike plain pyserial, reads are awaited on the asyncio event loop so
+# they don't block sending messages to IoT Hub
+import serial_asyncio
 
 # The azure-iot-device package contains classes to connect to Azure IoT Hub
 from azure.iot.device import Message
@@ -28,14 +34,18 @@ from azure.iot.device.aio import IoTHubDeviceClient
 # THe python-dotenv package allows loading environment variables from .env files
 from dotenv import load_dotenv
 
-class LatLon(NamedTuple):
+# The gps_core module contains the code shared by all the device apps to read and decode
+# GPS coordinates. This lives in the parent folder, so add that to the module search path
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+from gps_core import LatLon, get_next_location  # pylint: disable=wrong-import-position
+
+class Fix(NamedTuple):
     '''
-    A named tuple type to define a GPS coordinate as a latitude and longitude,
-    along with the number of satellites use to get the fix
+    A named tuple type to define a GPS coordinate along with the UTC time it was read,
+    so the order of the coordinates is kept when they are sent in batches
     '''
-    lat: float
-    lon: float
-    num_satellites: int
+    timestamp: str
+    lat_lon: LatLon
 
 # Load the .env file into environment variables. This file allows the connection string to be
 # kept out of code and loaded on demand. The .env file should not be stored in source code control.
@@ -45,27 +55,17 @@ load_dotenv()
 # Get the IoT Hub connection string from an environment variable
 CONNECTION_STRING = os.environ['CONNECTION_STRING']
 
-def flush_serial(serial_conn: serial.Serial) -> None:
-    '''
-    Drains the serial data from the UART connection.
-    This is done so we can read data every minute, and ignore the data in-between
-    '''
-    # Clear and flush the input buffer to remove all data
-    serial_conn.reset_input_buffer()
-    serial_conn.flush()
-
-    # Try to read and decode a line. This is needed as the data is utf-8, so can be variable width
-    # and we don't want to read a partial line that starts part-way through a variable width character.
-    # The code here will read until is gets a full line that can be decoded successfully
-    line = None
-    while not line:
-        try:
-            # Decode the line as utf-8
-            line = serial_conn.readline().decode('utf-8').strip()
-        except UnicodeDecodeError:
-            # If we are reading part way through a character, this exception will be thrown.
-            # Reset the line and read again
-            line = None
+# The number of GPS coordinates to collect before sending them all to Azure IoT Hub in one go.
+# Sending in batches means the radio is used less often, saving battery
+BATCH_SIZE = 5
+
+# The longest time in seconds to hold on to coordinates before sending them, even if the batch isn't full.
+# This means coordinates are still sent when the GPS fix is patchy and the batch fills up slowly
+BATCH_INTERVAL = 300
+
+# A template for the JSON messages sent to IoT Hub. Each message is built by filling in this
+# template rather than creating a new dictionary and converting it to JSON every time
+MESSAGE_TEMPLATE = '{{"gps":{{"lat":{lat!r},"lon":{lon!r},"num_satellites":{num_satellites},"timestamp":"{timestamp}"}}}}'
 
 async def connect_to_iot_hub() -> IoTHubDeviceClient:
     '''
@@ -73,8 +73,17 @@ async def connect_to_iot_hub() -> IoTHubDeviceClient:
     This returns a device client instance that can be used to send telemetry or
     subscribe to direct methods.
     '''
-    # Create a device client from the connection string. This client starts off disconnected
-    device_client = IoTHubDeviceClient.create_from_connection_string(CONNECTION_STRING)
+    # Create a device client from the connection string. This client starts off disconnected.
+    # The same client is used for the lifetime of the app, so it is set up to keep the connection alive:
+    # - keep_alive pings IoT Hub every 2 minutes whilst no messages are being sent, so the connection stays
+    #   open between batches without using the radio as often as the default of 60 seconds
+    # - auto_connect reconnects automatically if a message is sent whilst disconnected
+    # - connection_retry retries every 10 seconds if the connection is lost
+    device_client = IoTHubDeviceClient.create_from_connection_string(CONNECTION_STRING,
+                                                                     keep_alive=120,
+                                                                     auto_connect=True,
+                                                                     connection_retry=True,
+                                                                     connection_retry_interval=10)
 
     print('Connecting')
     # Connect the device client to Azure IoT Hub
@@ -83,67 +92,33 @@ async def connect_to_iot_hub() -> IoTHubDeviceClient:
 
     return device_client
 
-def get_next_location(serial_conn: serial.Serial) -> LatLon:
+async def track_location(reader: asyncio.StreamReader, locations: asyncio.Queue) -> None:
     '''
-    Gets the next lat and lon pair from the GPS sensor.
-
-    This reads data from the serial port until a GGA sentence is read - this is the sentence
-    with the GPS coordinates read from satelites. Once this sentence is read, the lat and lon
-    are returned as a tuple.
+    Continuously reads GPS coordinates from the GPS sensor.
 
-    If no GPS coordinates are found, -999, -999 is returned.
+    The serial data is always being read, so rather than draining it before each reading, this keeps
+    only the most recent valid coordinates in the locations queue, ready to be added to the next batch.
     '''
-    # Drain the serial buffer as we want the latest GPS reading
-    flush_serial(serial_conn)
-
-    # Set up a retry count - this code will try 100 times to get a valid
-    # GGA sentence, that is a sentence that has GPS coordinates from multiple
-    # satellites
-    retry = 0
-
-    # Start looping looking for a GGA sentence
-    while retry < 100:
-        # Read the next line from the serial buffer
-        line = serial_conn.readline().decode('utf-8')
-
-        # Try reading a sentence from the line read from the GPS sensor.
-        # If the line read is incomplete, the sentence will fail to parse, so we can try again
-        sentence = None
-        while sentence is None:
-            try:
-                # Use PyNMEA to parse the NMEA sentence from the line of data
-                sentence = pynmea2.parse(line)
-            except pynmea2.nmea.ParseError:
-                # If we get a parse error, read the next line
-                line = serial_conn.readline().decode('utf-8')
-
-        # Each sentence has a type specifying the data it has. This code is after a GGA
-        # sentence which has the GPS position
-        if sentence.sentence_type == 'GGA':
-            # If we have a GGA, read the lat and lon. The values are in degrees and minutes, so
-            # convert to decimal degrees
-            lat = pynmea2.dm_to_sd(sentence.lat)
-            lon = pynmea2.dm_to_sd(sentence.lon)
-
-            # The positions are given as N/S or E/W. For decimal degrees, these should be converted
-            # to positive or negative values. S of the equator is negative, so is west of the
-            # prime meridian
-            if sentence.lat_dir == 'S':
-                lat = lat * -1
-
-            if sentence.lon_dir == 'W':
-                lon = lon * -1
-
-            # Return the lat, lon, and number of satellites as a tuple
-            return LatLon(lat, lon, sentence.num_sats)
-
-        # Increment the retry
-        retry += 1
-
-    # If we don't successfully get a lat and lon, return -999,-999
-    return LatLon(-999, -999)
-
-async def send_message(device_client: IoTHubDeviceClient, lat_lon: LatLon) -> None:
+    # There's no need to skip any partial line when reading starts, as get_next_location only
+    # decodes full sentences that start with a $
+
+    # Loop forever reading coordinates
+    while True:
+        # Get the latest GPS coordinates, reading blocks of data from the serial port. The stream reader
+        # buffers the serial data as it arrives, so this only waits if there isn't a full block available yet
+        lat_lon = await get_next_location(reader.readexactly)
+
+        # If there isn't a valid set of coordinates available, the call to get_next_location will
+        # return -999, -999 as the location. Test for this and only proceed if the coordinates are valid
+        if lat_lon.lat > -999 and lat_lon.lon > -999:
+            # The queue only holds a single location, so replace any older location with this one
+            if locations.full():
+                locations.get_nowait()
+
+            # Tag the coordinates with the time they were read
+            locations.put_nowait(Fix(datetime.now(timezone.utc).isoformat(), lat_lon))
+
+async def send_message(device_client: IoTHubDeviceClient, fix: Fix) -> None:
     '''
     Send a message to the IoT device client with the lat and lon.
     The message is in the following format:
@@ -152,53 +127,110 @@ async def send_message(device_client: IoTHubDeviceClient, lat_lon: LatLon) -> No
         "gps": {
             "lat": <lat>,
             "lon": <lon>,
-            "num_satellites": <num_satellites>
+            "num_satellites": <num_satellites>,
+            "timestamp": <timestamp>
         }
     }
 
-    where <lat> and <lon> are floating point numbers and <num_satellites> is an int
+    where <lat> and <lon> are floating point numbers, <num_satellites> is an int, and <timestamp>
+    is the UTC time the coordinates were read as an ISO 8601 string
     '''
-    # Build the message as JSON
-    message_json = { 'gps' : { 'lat':lat_lon.lat, 'lon':lat_lon.lon, 'num_satellites': lat_lon.num_satellites } }
+    # Build the message as JSON from the template
+    lat_lon = fix.lat_lon
+    message_json = MESSAGE_TEMPLATE.format(lat=lat_lon.lat, lon=lat_lon.lon, num_satellites=lat_lon.num_satellites,
+                                           timestamp=fix.timestamp)
 
     print('Sending telemetry', message_json)
 
-    # Create the message as a string created from the JSON
-    message = Message(json.dumps(message_json))
+    # Create the message from the JSON. A new message is needed each time, as messages in the same batch
+    # are sent at the same time, and the IoT Hub client holds on to each one until it has been sent
+    message = Message(message_json)
 
     # Send the message to Azure IoT Hub as a device to cloud (D2C) message
     await device_client.send_message(message)
 
+async def send_batch(device_client: IoTHubDeviceClient, batch: deque) -> None:
+    '''
+    Sends all the coordinates in the batch as messages to Azure IoT Hub.
+
+    Any coordinates that fail to send are left in the batch, so they are sent again with the next batch.
+    '''
+    # Send all the messages at once over the same connection. They may arrive in any order,
+    # but each one has the timestamp of when it was read so they can be put back in order
+    results = await asyncio.gather(*(send_message(device_client, fix) for fix in batch), return_exceptions=True)
+
+    # Keep only the coordinates that failed to send
+    failed = [fix for fix, result in zip(batch, results) if isinstance(result, Exception)]
+    batch.clear()
+    batch.extend(failed)
+
+    if failed:
+        print(f'Failed to send {len(failed)} messages, these will be sent with the next batch')
+
+async def send_locations(device_client: IoTHubDeviceClient, locations: asyncio.Queue) -> None:
+    '''
+    Collects the latest GPS coordinates every 60 seconds, and sends them to Azure IoT Hub
+    in batches of BATCH_SIZE, or after BATCH_INTERVAL seconds if the batch isn't full by then.
+    '''
+    # The coordinates waiting to be sent. Coordinates that fail to send stay in here to be sent again,
+    # and this has a maximum length so if sending keeps failing, the oldest coordinates are dropped
+    # rather than using up all the memory
+    batch = deque(maxlen=BATCH_SIZE)
+
+    # The time the first coordinates in the current batch were collected
+    loop = asyncio.get_running_loop()
+    batch_started = loop.time()
+
+    # Loop forever collecting coordinates
+    while True:
+        # Sleep for 60 seconds between coordinates
+        await asyncio.sleep(60)
+
+        # Get the latest coordinates. If there are none yet, this will wait until a valid set is read.
+        # If there are coordinates waiting to be sent, only wait until the batch is due to be sent
+        timeout = max(batch_started + BATCH_INTERVAL - loop.time(), 0) if batch else None
+        try:
+            fix = await asyncio.wait_for(locations.get(), timeout)
+
+            if not batch:
+                batch_started = loop.time()
+
+            batch.append(fix)
+        except asyncio.TimeoutError:
+            pass
+
+        # Send the batch once it is full, or once the coordinates in it have waited for BATCH_INTERVAL seconds
+        if len(batch) == BATCH_SIZE or (batch and loop.time() - batch_started >= BATCH_INTERVAL):
+            await send_batch(device_client, batch)
+            batch_started = loop.time()
+
 async def main() -> None:
     '''
     The main loop of the application.
 
     This connects to the serial port, connects this device to IoT Hub, then sends GPS coordinates.
-    The coordinates are polled for every 60 seconds in an infinite loop and sent to Azure IoT Hub
+    The coordinates are read continuously, and the latest are collected every 60 seconds and sent to
+    Azure IoT Hub in batches
     '''
     # Connect to the GPS sensor. This is always a serial connection at 9,600 baud
-    # on the /dev/ttyAMA0 port
-    serial_connection = serial.Serial('/dev/ttyAMA0', 9600, timeout=1)
-
-    # Clear out any serial data to ensure we are reading full sentences
-    flush_serial(serial_connection)
+    # on the /dev/ttyAMA0 port. On Windows, pyserial-asyncio falls back to polling the serial port
+    reader, _ = await serial_asyncio.open_serial_connection(url='/dev/ttyAMA0', baudrate=9600)
 
     # Connect this device to Azure IoT Hub
     device_client = await connect_to_iot_hub()
 
-    # The main loop of the application. Loop forever
-    while True:
-        # Get the latest GPS coordinates
-        lat_lon = get_next_location(serial_connection)
+    # A queue holding the latest valid coordinates read from the GPS sensor
+    locations = asyncio.Queue(maxsize=1)
 
-        # If there isn't a valid set of coordinates available, the call to get_next_location will
-        # return -999, -999 as the location. Test for this and only proceed if the coordinates are valid
-        if lat_lon.lat > -999 and lat_lon.lon > -999:
-            # If the coordinates are valid, send the lat and lon as a message to Azure IoT Hub
-            await send_message(device_client, lat_lon)
+    # Read coordinates and send messages at the same time, so neither blocks the other
+    await asyncio.gather(track_location(reader, locations), send_locations(device_client, locations))
 
-        # Sleep for 60 seconds between coordinated
-        await asyncio.sleep(60)
+# Start the main loop running, using uvloop if it is installed. uvloop.run was added in uvloop 0.18,
+# so with older versions, such as a distro-packaged uvloop, install it as the event loop policy instead
+if uvloop is not None and hasattr(uvloop, 'run'):
+    uvloop.run(main())
+else:
+    if uvloop is not None:
+        uvloop.install()
 
-# Start the main loop running.
-asyncio.run(main())
+    asyncio.run(main())
@@ -3,33 +3,73 @@ An Azure Function that listens on an IoT Hub event hub compatible endpoint.
 When events are received, they are formatted correctly as geospatial data
 and saved in CosmosDB
 '''
-import json
 import logging
+import math
+from typing import List, Optional
 
 import azure.functions as func
 
-def main(event: func.EventHubEvent) -> func.Document:
+# The orjson library is a fast JSON library, used to read the events and create the records
+import orjson
+
+# A template for the JSON document stored in CosmosDB. The document is built by filling in this
+# template rather than creating a new dictionary and converting it to JSON for every event
+RECORD_TEMPLATE = ('{{"animalid":{animalid},"num_satellites":{num_satellites},"timestamp":{timestamp},'
+                   '"location":{{"type":"Point","coordinates":[{lon},{lat}]}}}}')
+
+def build_record(event: func.EventHubEvent) -> Optional[func.Document]:
+    '''
+    Builds the document to be stored in CosmosDB from a single IoT Hub event.
+
+    If the event can't be read, for example it is missing a field or has coordinates that aren't
+    valid numbers, it is logged and None is returned.
+    '''
+    try:
+        # Extract the body from the IoT Hub event, and convert to a JSON object
+        body = event.get_body().decode('utf-8')
+        logging.info('Python EventHub trigger processed an event: %s', body)
+        json_body = orjson.loads(body)
+
+        # Build a JSON document to be stored in CosmosDB
+        # This record uses the device ID of the sending device as the animal ID
+        # and stores the lat/lon in a way that can be saved and queried as GeoSpatial data
+        # The timestamp is the time the device read the coordinates, as these are sent in batches.
+        # Messages from devices that don't send a timestamp are stored with a null timestamp
+        # The strings are quoted with orjson so they are always valid JSON, and the numbers are
+        # converted to make sure they are numbers
+        gps = json_body['gps']
+        lon = float(gps['lon'])
+        lat = float(gps['lat'])
+
+        # float accepts values like nan and inf, but these can't be written as JSON
+        if not math.isfinite(lon) or not math.isfinite(lat):
+            raise ValueError(f'Invalid coordinates: {lon}, {lat}')
+
+        record = RECORD_TEMPLATE.format(animalid=orjson.dumps(event.iothub_metadata['connection-device-id']).decode('utf-8'),
+                                        num_satellites=int(gps['num_satellites']),
+                                        timestamp=orjson.dumps(gps.get('timestamp')).decode('utf-8'),
+                                        lon=lon,
+                                        lat=lat)
+
+        # Create the document from the JSON. This is done here so that any JSON that can't be read
+        # is handled the same as any other malformed event
+        document = func.Document.from_json(record)
+    except (KeyError, TypeError, ValueError):
+        # If the event is malformed, skip it so it doesn't stop the rest of the batch from being saved
+        logging.exception('Skipping event that could not be read: %r', event.get_body())
+        return None
+
+    logging.info('Storing record: %s', record)
+    return document
+
+def main(events: List[func.EventHubEvent]) -> func.DocumentList:
     '''
     An Azure Function that listens on an IoT Hub event hub compatible endpoint.
     When events are received, they are formatted correctly as geospatial data
     and saved in CosmosDB
-    '''
-    # Extract the body from the IoT Hub event, and convert to a JSON object
-    body = event.get_body().decode('utf-8')
-    logging.info('Python EventHub trigger processed an event: %s', body)
-    json_body = json.loads(body)
-
-    # Build a JSON document to be stored in CosmosDB
-    # This record uses the device ID of the sending device as the animal ID
-    # and stores the lat/lon in a way that can be saved and queried as GeoSpatial data
-    record = {
-        'animalid': event.iothub_metadata['connection-device-id'],
-        'num_satellites': json_body['gps']['num_satellites'],
-        'location':{
-            'type':'Point',
-            'coordinates':[ json_body['gps']['lon'], json_body['gps']['lat'] ]
-        }
-    }
 
-    logging.info('Storing record: %s', record)
-    return func.Document.from_json(json.dumps(record))
+    Events are received in batches, and all the records from a batch are saved to CosmosDB together.
+    Any events that can't be read are skipped
+    '''
+    documents = (build_record(event) for event in events)
+    return func.DocumentList([document for document in documents if document is not None])